@@ -8,57 +8,87 @@ import subprocess
 import re
 import hashlib
 from pathlib import Path
-from ast import literal_eval
-from typing import Optional, Set
+from typing import Iterator, Optional, Set
 from contextlib import contextmanager
 from tempfile import TemporaryDirectory
-from functools import reduce, cache
+from functools import cache
+from concurrent.futures import ThreadPoolExecutor
+import queue
 import os
 import argparse
 
 
-def run(cmd: list[str], verbose=True, **kwargs) -> subprocess.CompletedProcess:
-    """wrapper around subprocess.run that prints the command if verbose=True and fails if command fails"""
+def run(
+    cmd: list[str], verbose=True, cwd: Optional[str] = None, **kwargs
+) -> subprocess.CompletedProcess:
+    """wrapper around subprocess.run that prints the command if verbose=True and fails if command fails
+
+    the command is run in directory `cwd` if specified, the process working directory is never changed
+    """
+    if verbose:
+        if cwd is None:
+            print("Running", " ".join(cmd))
+        else:
+            print("Running in", cwd + ":", " ".join(cmd))
+    return subprocess.run(cmd, check=True, cwd=cwd, **kwargs)
+
+
+def run_lines(cmd: list[str], verbose=True, **kwargs) -> Iterator[str]:
+    """like run, but yields the lines the command prints on stdout as they come, instead of buffering its whole output"""
     if verbose:
         print("Running", " ".join(cmd))
-    return subprocess.run(cmd, check=True, **kwargs)
+    with subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, encoding="utf8", errors="ignore", **kwargs
+    ) as p:
+        yield from p.stdout
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+
 
+output_re = re.compile(rb'"(/nix/store/[^"]+)"')
 
+
+@cache
 def get_outputs(drv: str) -> list[str]:
     """gets the output paths of a drv file"""
-    with open(drv) as f:
+    with open(drv, "rb") as f:
         txt = f.read()
-    start = txt.index("[")
-    txt = txt[start:]
-    end = txt.index("]")
-    txt = txt[: end + 1]
-    data = literal_eval(txt)
-    return [i[1] for i in data]
+    start = txt.index(b"[")
+    end = txt.index(b"]", start)
+    return [i.decode("utf8", errors="ignore") for i in output_re.findall(txt, start, end)]
 
 
-def is_built(drv: str) -> bool:
-    """determines wether a drv file has been build locally
+def get_built(drvs: Set[str]) -> Set[str]:
+    """returns the subset of these drv files that have been built locally
 
-    actually whether its build outputs are present in the store
+    actually those one of whose build outputs is present in the store. The
+    store is listed once instead of checking every output path.
     """
-    for line in get_outputs(drv):
-        assert line.startswith("/nix/store")
-        if Path(line).exists():
-            return True
-    return False
-
+    store = set(os.listdir("/nix/store"))
+    res = set()
+    for drv in drvs:
+        for path in get_outputs(drv):
+            assert path.startswith("/nix/store/")
+            if path.removeprefix("/nix/store/") in store:
+                res.add(drv)
+                break
+    return res
 
-@cache
-def get_git_folder() -> Path:
-    path = run(["git", "rev-parse", "--git-dir"], verbose=False, stdout=subprocess.PIPE).stdout.decode("utf8", errors="ignore")
-    return Path(path.strip()).resolve()
 
 def get_good_refs() -> list[str]:
-    """returns all references in the form refs/bisect/good-*"""
-    repo = get_git_folder()
-    return [str(i.relative_to(repo)) for i in (repo / "refs" / "bisect").glob("good-*")]
+    """returns the commit hashes of all references in the form refs/bisect/good-*"""
+    return (
+        run(
+            ["git", "for-each-ref", "--format=%(objectname)", "refs/bisect/good-*"],
+            verbose=False,
+            stdout=subprocess.PIPE,
+        )
+        .stdout.decode("utf8", errors="ignore")
+        .split()
+    )
 
 
+@cache
 def git_rev_parse(rev: str) -> str:
     """canonicalize a reference to a commit hash"""
     return (
@@ -68,43 +98,119 @@ def git_rev_parse(rev: str) -> str:
     )
 
 
-def get_bisect_commits(bad: str, goods: list[str]) -> list[str]:
-    """returns all commits that git bisect may visit if refs/bisect/bad is `bad` and refs/bisect-good* are `goods`, as commit hashes"""
-    bad = git_rev_parse(bad)
+def get_bisect_graph(bad: str, goods: tuple[str, ...]) -> dict[str, list[str]]:
+    """returns the graph of commits that git bisect may visit if refs/bisect/bad is `bad` and refs/bisect-good* are `goods`
+
+    maps each commit hash of the range, `bad` included, to the list of its
+    parents within the range. Children come before their parents, so `bad`
+    comes first.
+    """
     assert len(goods) >= 1
-    out = run(
-        ["git", "log", "--pretty=oneline", bad, "--not"] + goods,
+    graph = {}
+    for line in run_lines(
+        ["git", "rev-list", "--topo-order", "--parents", bad, "--not", *goods],
         verbose=False,
-        stdout=subprocess.PIPE,
-    ).stdout.decode("utf8", errors="ignore")
-    res = []
-    for line in out.splitlines():
+    ):
+        line = line.strip()
         if not line:
             continue
-        words = line.strip().split(" ")
-        commit = words[0]
-        if commit != bad:
-            res.append(commit)
+        commit, *parents = line.split(" ")
+        graph[commit] = parents
+    return {
+        commit: [parent for parent in parents if parent in graph]
+        for commit, parents in graph.items()
+    }
+
+
+def get_ancestors(graph: dict[str, list[str]]) -> dict[str, frozenset[str]]:
+    """for each commit of a graph returned by get_bisect_graph, returns the set of its ancestors within the graph, itself included"""
+    ancestors = {}
+    for commit in reversed(graph):
+        ancestors[commit] = frozenset([commit]).union(
+            *(ancestors[parent] for parent in graph[commit])
+        )
+    return ancestors
+
+
+def union_over_ancestors(graph: dict[str, list[str]], masks: dict[str, int]) -> dict[str, int]:
+    """for each commit of a graph returned by get_bisect_graph, returns the union of the bitmasks of its ancestors within the graph, itself included
+
+    commits absent from `masks` count as the empty bitmask
+    """
+    res = {}
+    for commit in reversed(graph):
+        mask = masks.get(commit, 0)
+        for parent in graph[commit]:
+            mask |= res[parent]
+        res[commit] = mask
     return res
 
 
-def hash(string: str) -> str:
-    """hashes a string"""
-    m = hashlib.sha256()
-    m.update(string.encode("utf8"))
-    return m.hexdigest()
+def union_over_descendants(graph: dict[str, list[str]], masks: dict[str, int]) -> dict[str, int]:
+    """for each commit of a graph returned by get_bisect_graph, returns the union of the bitmasks of its descendants within the graph, itself included
 
+    commits absent from `masks` count as the empty bitmask
+    """
+    res = {commit: masks.get(commit, 0) for commit in graph}
+    for commit in graph:
+        for parent in graph[commit]:
+            res[parent] |= res[commit]
+    return res
 
-def cache_file_for(hash: str) -> Path:
-    """returns the path to a cache file depending on this hash only
 
-    its parent dir is guaranteed to exist
+def get_frontiers(
+    graph: dict[str, list[str]], ancestors: dict[str, frozenset[str]]
+) -> dict[str, frozenset[str]]:
+    """for each commit of a graph returned by get_bisect_graph, returns a set of commits which are not its ancestors, and such that every commit of the graph which is not its ancestor descends from one of them
+
+    `ancestors` must be the result of get_ancestors(graph). The frontier of a
+    commit is made of its children, of the roots of the graph, and of the
+    frontiers of its parents, minus its ancestors. In a linear history, this
+    is just the child of the commit.
     """
+    children = {commit: [] for commit in graph}
+    for commit, parents in graph.items():
+        for parent in parents:
+            children[parent].append(commit)
+    roots = frozenset(commit for commit, parents in graph.items() if not parents)
+    res = {}
+    for commit in reversed(graph):
+        candidates = roots.union(
+            children[commit], *(res[parent] for parent in graph[commit])
+        )
+        res[commit] = candidates - ancestors[commit]
+    return res
+
+
+def to_bitmasks(sets: dict[str, Set[str]]) -> dict[str, int]:
+    """represents each of these sets as an integer bitmask, every distinct element being assigned a bit"""
+    index = {element: i for i, element in enumerate(set().union(*sets.values()))}
+    res = {}
+    for key, elements in sets.items():
+        # ORing bits one by one into an int would copy the whole int each
+        # time; instead write the binary representation and parse it once
+        digits = bytearray(b"0" * len(index))
+        for element in elements:
+            digits[index[element]] = ord("1")
+        res[key] = int(digits[::-1] or b"0", 2)
+    return res
+
+
+@cache
+def get_cache_dir() -> Path:
+    """returns the directory of the on-disk cache, creating it on first call"""
     cachedir = os.environ.get("XDG_CACHE_HOME", os.environ["HOME"] + "/.cache")
     d = Path(cachedir) / "bisecter"
     d.mkdir(exist_ok=True)
-    f = d / hash
-    return f
+    return d
+
+
+def cache_file_for(hash: str) -> Path:
+    """returns the path to a cache file depending on this hash only
+
+    its parent dir is guaranteed to exist
+    """
+    return get_cache_dir() / hash
 
 
 def cache_for(hash: str) -> Optional[str]:
@@ -123,50 +229,90 @@ def write_cache_for(hash: str, value: str):
         t.write(value)
 
 
-drv_re = re.compile(r"/nix/store/[^/ ]*\.drv")
+drv_re = re.compile(rb"/nix/store/[^/ ]*\.drv")
+
 
+# to be bumped when the format of cached drvs changes
+drvs_cache_version = "2"
 
-def get_drvs_inner(commit: str, cmd: list[str]) -> Set[str]:
-    """check-out this commit, and runs this command with --dry-run and parses all drvs that would be built"""
-    run(["git", "checkout", commit])
-    out = run(cmd + ["--dry-run"], stderr=subprocess.PIPE).stderr.decode(
-        "utf8", errors="ignore"
+
+def drvs_cache_hasher(cmd: list[str]) -> hashlib.blake2b:
+    """returns a hasher already fed with the part of the cache keys of drvs that only depends on this command"""
+    prefix = drvs_cache_version + ";" + ";".join(cmd) + ";"
+    return hashlib.blake2b(prefix.encode("utf8"), digest_size=16)
+
+
+def drvs_cache_key(hasher: hashlib.blake2b, commit: str) -> str:
+    """returns the hash under which the drvs of this commit are cached
+
+    `hasher` is the result of drvs_cache_hasher for the command, and is left untouched
+    """
+    h = hasher.copy()
+    h.update(commit.encode("utf8"))
+    return h.hexdigest()
+
+
+def get_drvs_inner(commit: str, cmd: list[str], cwd: str) -> Set[str]:
+    """check-out this commit in worktree `cwd`, and runs this command with --dry-run there and parses all drvs that would be built"""
+    head = (
+        run(["git", "rev-parse", "HEAD"], verbose=False, cwd=cwd, stdout=subprocess.PIPE)
+        .stdout.decode("utf8", errors="ignore")
+        .strip()
     )
-    return set(drv_re.findall(out))
+    if head != git_rev_parse(commit):
+        run(["git", "checkout", "--quiet", "--detach", commit], cwd=cwd)
+    out = run(cmd + ["--dry-run"], cwd=cwd, stderr=subprocess.PIPE).stderr
+    return {drv.decode("utf8", errors="ignore") for drv in drv_re.findall(out)}
 
 
-def get_drvs(commit: str, cmd: list[str]) -> Set[str]:
-    """check-out this commit, and runs this command with --dry-run and parses all drvs that would be built
+def get_drvs(commits: list[str], cmd: list[str], jobs: int) -> dict[str, Set[str]]:
+    """for each commit, check-out this commit, and runs this command with --dry-run and parses all drvs that would be built and are not built yet
 
-    memoized
+    memoized. Commits missing from the cache are handled by up to `jobs`
+    parallel workers, each in its own worktree.
     """
-    h = hash(commit + ";" + ";".join(cmd))
-    t = cache_for(h)
-    if t is not None:
-        v = literal_eval(t)
-    else:
-        v = get_drvs_inner(commit, cmd)
-        write_cache_for(h, repr(v))
-    return {drv for drv in v if not is_built(drv)}
+    hasher = drvs_cache_hasher(cmd)
+    res = {}
+    missing = []
+    for commit in commits:
+        t = cache_for(drvs_cache_key(hasher, commit))
+        if t is not None:
+            res[commit] = set(t.splitlines())
+        else:
+            missing.append(commit)
+    if missing:
+        with worktree(min(jobs, len(missing))) as paths:
+            free = queue.Queue()
+            for path in paths:
+                free.put(path)
+
+            def work(commit: str) -> Set[str]:
+                path = free.get()
+                try:
+                    v = get_drvs_inner(commit, cmd, path)
+                finally:
+                    free.put(path)
+                write_cache_for(drvs_cache_key(hasher, commit), "\n".join(sorted(v)))
+                return v
+
+            with ThreadPoolExecutor(max_workers=len(paths)) as executor:
+                for commit, v in zip(missing, executor.map(work, missing)):
+                    res[commit] = v
+    built = get_built(set().union(*res.values()))
+    return {commit: v - built for commit, v in res.items()}
 
 
 @contextmanager
-def worktree():
-    """context manager that sets up a temporary git worktree at HEAD"""
-    pwd = os.getcwd()
-    exc = None
-    with TemporaryDirectory() as tmpdir:
-        f = str(tmpdir) + "/w"
-        run(["git", "worktree", "add", f, "HEAD"])
-        os.chdir(f)
-        try:
-            yield
-        except BaseException as e:
-            exc = e
-    os.chdir(pwd)
-    run(["git", "worktree", "prune"])
-    if exc:
-        raise exc
+def worktree(n: int):
+    """context manager that sets up n temporary git worktrees at HEAD and yields the list of their paths"""
+    try:
+        with TemporaryDirectory() as tmpdir:
+            paths = [str(tmpdir) + f"/w{i}" for i in range(n)]
+            for path in paths:
+                run(["git", "worktree", "add", path, "HEAD"])
+            yield paths
+    finally:
+        run(["git", "worktree", "prune"])
 
 
 if __name__ == "__main__":
@@ -198,36 +344,51 @@ if __name__ == "__main__":
         help="checkout best candidate after computation",
         action="store_true",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="""number of commits to run the command on in parallel, each in
+        its own worktree (default: 1). Mind that each evaluation of nixpkgs can
+        take several GB of memory.""",
+        type=int,
+        default=1,
+    )
     args = parser.parse_args()
     if len(args.cmd) == 0:
         print("no command given")
         exit(1)
+    if args.jobs < 1:
+        print("--jobs must be at least 1")
+        exit(1)
     goods = get_good_refs()
     bad = "refs/bisect/bad"
-    commits = get_bisect_commits(bad=bad, goods=goods)
+    graph = get_bisect_graph(bad=bad, goods=tuple(goods))
+    # git bisect never visits bad itself
+    commits = list(graph)[1:]
     n = len(commits)
     print("found", n, "commits")
-    rebuilds = {}
-    with worktree():
-        for commit in commits:
-            rebuilds[commit] = get_drvs(commit, args.cmd)
+    rebuilds = get_drvs(commits, args.cmd, args.jobs)
+    ancestors = get_ancestors(graph)
+    masks = to_bitmasks(rebuilds)
+    masks_of_ancestors = union_over_ancestors(graph, masks)
+    masks_of_descendants = union_over_descendants(graph, masks)
+    frontiers = get_frontiers(graph, ancestors)
     weights = []
     for commit in commits:
-        candidates_if_good = get_bisect_commits(bad=bad, goods=goods + [commit])
-        candidates_if_bad = get_bisect_commits(bad=commit, goods=goods)
-        rebuilds_if_good = len(
-            reduce(lambda a, b: a | b, (rebuilds[i] for i in candidates_if_good), set())
-            - rebuilds[commit]
-        )
-        rebuilds_if_bad = len(
-            reduce(lambda a, b: a | b, (rebuilds[i] for i in candidates_if_bad), set())
-            - rebuilds[commit]
-        )
+        # if commit is good, the remaining candidates are all the commits which
+        # are not its ancestors, thus descendants of its frontier
+        candidates_if_good = n - len(ancestors[commit])
+        candidates_if_bad = len(ancestors[commit]) - 1
+        mask_if_good = 0
+        for i in frontiers[commit]:
+            mask_if_good |= masks_of_descendants[i]
+        rebuilds_if_good = (mask_if_good & ~masks[commit]).bit_count()
+        rebuilds_if_bad = (masks_of_ancestors[commit] & ~masks[commit]).bit_count()
         w = (
             len(rebuilds[commit])
             + (
-                len(candidates_if_good) * rebuilds_if_good
-                + len(candidates_if_bad) * rebuilds_if_bad
+                candidates_if_good * rebuilds_if_good
+                + candidates_if_bad * rebuilds_if_bad
             )
             / n
         )
@@ -235,8 +396,8 @@ if __name__ == "__main__":
             (
                 w,
                 commit,
-                len(candidates_if_good),
-                len(candidates_if_bad),
+                candidates_if_good,
+                candidates_if_bad,
                 rebuilds_if_good,
                 rebuilds_if_bad,
             )